@@ -0,0 +1,308 @@
+"""Video decoding helpers for the GIF converter.
+
+Kept out of main.py so worker processes can import them without running
+the Streamlit page setup.
+"""
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import av
+import numpy as np
+from av.video.reformatter import VideoReformatter
+
+try:
+    import torch
+    from torchcodec.decoders import VideoDecoder
+    USE_GPU = torch.cuda.is_available()
+except ImportError:
+    USE_GPU = False
+
+# Below this many samples, process start-up costs more than it saves
+PARALLEL_MIN_SAMPLES = 16
+
+# Forking Streamlit's threaded server can copy a lock another thread holds
+# and deadlock the worker, so start workers from a clean process instead
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver"
+    if "forkserver" in multiprocessing.get_all_start_methods()
+    else "spawn"
+)
+
+
+def probe_video(video_path: str) -> Tuple[float, int, int, float]:
+    """Return the duration (seconds), width, height and frame rate."""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        else:
+            duration = container.duration / av.time_base
+        fps = float(stream.average_rate or stream.guessed_rate or 0)
+        return duration, stream.width, stream.height, fps
+
+
+def _start_pts(stream: av.video.stream.VideoStream) -> int:
+    """Return the PTS the stream starts at; sample times are offsets from it."""
+    return stream.start_time if stream.start_time is not None else 0
+
+
+def keyframe_times(video_path: str) -> np.ndarray:
+    """Return keyframe times relative to the stream start, without decoding."""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        start_pts = _start_pts(stream)
+        times = [
+            float((packet.pts - start_pts) * stream.time_base)
+            for packet in container.demux(stream)
+            if packet.is_keyframe and packet.pts is not None
+        ]
+    return np.array(sorted(times))
+
+
+def _decimation_step(
+    target_pts: np.ndarray,
+    stream: av.video.stream.VideoStream
+) -> Optional[int]:
+    """Return the frame step if the targets sit on every Nth frame's PTS."""
+    fps = stream.average_rate
+    if len(target_pts) < 2 or not fps:
+        return None
+    # Counting is only exact when every frame lasts the same whole number of
+    # time-base ticks and every target is a whole number of frames later
+    frame_pts = 1 / (fps * stream.time_base)
+    if frame_pts.denominator != 1:
+        return None
+    steps = np.diff(target_pts)
+    step_pts = int(steps[0])
+    if step_pts <= 0 or step_pts % frame_pts.numerator:
+        return None
+    if not np.all(steps == step_pts):
+        return None
+    return step_pts // frame_pts.numerator
+
+
+def _iter_decimated(
+    frames: Iterator[av.VideoFrame],
+    target_pts: np.ndarray,
+    end_pts: int,
+    step_frames: int,
+    reformatter: VideoReformatter
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Keep every step_frames-th frame from the first target on, by counting."""
+    kept = 0
+    decoded = 0
+    next_target = target_pts[0]
+    for frame in frames:
+        pts = frame.pts
+        if pts is None or pts < target_pts[0]:
+            continue
+        if pts >= end_pts:
+            break
+        on_step = decoded % step_frames == 0
+        decoded += 1
+        if not on_step and pts < next_target:
+            continue
+        if not on_step or pts != next_target:
+            # A dropped, duplicated or variable-rate frame put the count off
+            # the grid: match the remaining samples on PTS from this frame
+            rest = _iter_by_pts(
+                itertools.chain([frame], frames),
+                target_pts[kept:],
+                end_pts,
+                reformatter
+            )
+            for i, rgb in rest:
+                yield kept + i, rgb
+            return
+        rgb = reformatter.reformat(frame, format='rgb24')
+        yield kept, rgb.to_ndarray()
+        kept += 1
+        if kept == len(target_pts):
+            break
+        next_target = target_pts[kept]
+
+
+def _iter_by_pts(
+    frames: Iterator[av.VideoFrame],
+    target_pts: np.ndarray,
+    end_pts: int,
+    reformatter: VideoReformatter
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Keep the first frame at or after each target PTS."""
+    i = 0
+    next_target = target_pts[0]
+    for frame in frames:
+        pts = frame.pts
+        if pts is None:
+            continue
+        if pts >= end_pts:
+            break
+        if pts >= next_target:
+            rgb = reformatter.reformat(frame, format='rgb24').to_ndarray()
+            # Reuse this frame for every sample time it covers
+            while i < len(target_pts) and pts >= target_pts[i]:
+                yield i, rgb
+                i += 1
+            if i == len(target_pts):
+                break
+            next_target = target_pts[i]
+
+
+def iter_samples(
+    video_path: str,
+    sample_times: np.ndarray,
+    end_time: float,
+    reformatter: Optional[VideoReformatter] = None
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yield (index, frame) for the first frame at or after each sample time."""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+
+        # Match frames on integer PTS in the stream's time base, which also
+        # absorbs the float drift of np.arange sample times. Sample times
+        # count from the start of the stream, which need not be PTS 0.
+        time_base = float(stream.time_base)
+        start_pts = _start_pts(stream)
+        target_pts = (
+            np.round(sample_times / time_base).astype(np.int64) + start_pts)
+        end_pts = int(round(end_time / time_base)) + start_pts
+
+        # Seek once to the keyframe before the first sample, then decode
+        # sequentially
+        container.seek(int(target_pts[0]), stream=stream)
+        frames = container.decode(stream)
+
+        # One reformatter for the whole pass keeps a single swscale context
+        # emitting packed rgb24 (no alpha) instead of rebuilding it per frame;
+        # callers making several passes can share theirs
+        if reformatter is None:
+            reformatter = VideoReformatter()
+
+        # When samples land exactly on whole frames, count frames instead
+        # of searching for each target
+        step_frames = _decimation_step(target_pts, stream)
+        if step_frames is not None:
+            yield from _iter_decimated(
+                frames, target_pts, end_pts, step_frames, reformatter)
+        else:
+            yield from _iter_by_pts(frames, target_pts, end_pts, reformatter)
+
+
+def decode_samples(
+    video_path: str,
+    sample_times: np.ndarray,
+    end_time: float
+) -> np.ndarray:
+    """Decode all sampled frames into one preallocated tensor."""
+    _, width, height, _ = probe_video(video_path)
+    frames = np.empty(
+        (len(sample_times), height, width, 3),
+        dtype=np.uint8
+    )
+    decoded = 0
+    for i, rgb in iter_samples(video_path, sample_times, end_time):
+        frames[i] = rgb
+        decoded = i + 1
+
+    # Drop sample slots past the last decodable frame
+    return frames[:decoded]
+
+
+def decode_samples_gpu(video_path: str, sample_times: np.ndarray) -> np.ndarray:
+    """Decode the frames shown at each sample time with NVDEC."""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        start_seconds = float(_start_pts(stream) * stream.time_base)
+
+    decoder = VideoDecoder(video_path, device='cuda')
+    batch = decoder.get_frames_played_at(
+        seconds=(sample_times + start_seconds).tolist())
+    # (N, 3, H, W) on the device -> (N, H, W, 3) on the host in one transfer
+    return batch.data.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+
+def _decode_bucket(
+    video_path: str,
+    start_index: int,
+    sample_times: np.ndarray,
+    end_time: float
+) -> Tuple[int, np.ndarray]:
+    """Worker entry point: decode one keyframe-aligned bucket of samples."""
+    return start_index, decode_samples(video_path, sample_times, end_time)
+
+
+def _partition_by_keyframe(
+    sample_times: np.ndarray,
+    keyframes: np.ndarray,
+    buckets: int
+) -> List[np.ndarray]:
+    """Split sample indices into roughly equal, keyframe-aligned buckets."""
+    # GOP each sample falls into, and the indices where a new GOP begins
+    gops = np.searchsorted(keyframes, sample_times, side='right') - 1
+    gop_starts = np.flatnonzero(np.diff(gops)) + 1
+    if len(gop_starts) == 0:
+        return [np.arange(len(sample_times))]
+
+    # Snap evenly spaced cut points forward to the next GOP boundary
+    targets = np.arange(1, buckets) * len(sample_times) // buckets
+    snapped = np.minimum(
+        np.searchsorted(gop_starts, targets), len(gop_starts) - 1)
+    cuts = np.unique(gop_starts[snapped])
+    return np.split(np.arange(len(sample_times)), cuts)
+
+
+def sample_frames(
+    video_path: str,
+    sample_times: np.ndarray,
+    end_time: float,
+    keyframes: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Decode frames at the sample times, across CPU cores for long windows."""
+    if USE_GPU:
+        return decode_samples_gpu(video_path, sample_times)
+
+    workers = os.cpu_count() or 1
+    if workers < 2 or len(sample_times) < PARALLEL_MIN_SAMPLES:
+        return decode_samples(video_path, sample_times, end_time)
+
+    if keyframes is None:
+        keyframes = keyframe_times(video_path)
+    window = end_time - sample_times[0]
+    gop_seconds = (
+        float(np.diff(keyframes).mean()) if len(keyframes) > 1 else window)
+    if window < 2 * gop_seconds:
+        return decode_samples(video_path, sample_times, end_time)
+
+    buckets = _partition_by_keyframe(sample_times, keyframes, workers)
+    if len(buckets) < 2:
+        return decode_samples(video_path, sample_times, end_time)
+
+    with ProcessPoolExecutor(
+        max_workers=len(buckets), mp_context=MP_CONTEXT
+    ) as executor:
+        futures = [
+            executor.submit(
+                _decode_bucket,
+                video_path,
+                int(bucket[0]),
+                sample_times[bucket],
+                end_time
+            )
+            for bucket in buckets
+        ]
+        results = [future.result() for future in futures]
+
+    # Gather every bucket into one preallocated tensor, in sample order
+    height, width = results[0][1].shape[1:3]
+    frames = np.empty(
+        (len(sample_times), height, width, 3), dtype=np.uint8)
+    decoded = 0
+    for start_index, chunk in results:
+        frames[start_index:start_index + len(chunk)] = chunk
+        if start_index == decoded:
+            decoded += len(chunk)
+
+    return frames[:decoded]
@@ -1,16 +1,40 @@
 import streamlit as st
-import moviepy.editor as mp
+import av
+import imageio.v3 as iio
+import asyncio
+import functools
 import tempfile
 import os
-from pathlib import Path
+import hashlib
+import io
+import mmap
+import shutil
+import subprocess
 import logging
-from typing import Optional, Tuple
+import time
+from fractions import Fraction
+from typing import BinaryIO, Callable, Iterable, Optional, Tuple
 import numpy as np
+from av.video.reformatter import VideoReformatter
+
+from decoding import iter_samples, keyframe_times, probe_video, sample_frames
+from quantize import (
+    exact_palette,
+    map_to_palette,
+    palette_from_histogram,
+    rgb565_histogram,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Used for the single-subprocess fast path when available
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Keep scratch output in RAM (tmpfs) where the platform offers it
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
 # Configure page settings
 st.set_page_config(
     page_title="Video to GIF Converter",
@@ -35,13 +59,18 @@ st.markdown("""
 class GIFConverter:
     """Handle video to GIF conversion operations."""
 
+    # Dithered presets go through ffmpeg's paletteuse; the others are
+    # quantized in NumPy against a single shared palette
     QUALITY_SETTINGS = {
-        "Best": {"opt": "-lossless"},
-        "Good": {"opt": None},
-        "Medium": {"opt": None},
-        "Low": {"opt": None}
+        "Best": {"dither": "sierra2_4a", "colors": 256},
+        "Good": {"dither": "floyd_steinberg", "colors": 256},
+        "Medium": {"dither": None, "colors": 256},
+        "Low": {"dither": None, "colors": 64}
     }
 
+    # Sampled windows larger than this (as RGB24) are streamed to the encoder
+    STREAMING_THRESHOLD = 512 * 1024 * 1024
+
     @staticmethod
     def validate_video(video_file) -> Tuple[bool, str]:
         """Validate the uploaded video file."""
@@ -53,6 +82,200 @@ class GIFConverter:
 
         return True, ""
 
+    @staticmethod
+    def _write_dithered_gif(
+        frames: Iterable[np.ndarray],
+        size: Tuple[int, int],
+        output: BinaryIO,
+        dither: str,
+        playback_interval: float,
+        repeat: str
+    ) -> None:
+        """Encode frames with ffmpeg's palettegen/paletteuse filters."""
+        # Set loop parameter based on repeat selection
+        loop = 0 if repeat == "Repeat" else -1
+
+        width, height = size
+
+        # Build a single palette from all frames and dither with it
+        filter_graph = (
+            {
+                "scale": ("scale", f"{width}:{height}"),
+                "split": ("split", ""),
+                "palettegen": ("palettegen", ""),
+                "paletteuse": ("paletteuse", f"dither={dither}"),
+            },
+            [
+                ("video_in", "scale", 0, 0),
+                ("scale", "split", 0, 0),
+                ("split", "palettegen", 0, 0),
+                ("split", "paletteuse", 1, 0),
+                ("palettegen", "paletteuse", 0, 1),
+                ("paletteuse", "video_out", 0, 0),
+            ]
+        )
+
+        with iio.imopen(
+            output,
+            "w",
+            plugin="pyav",
+            extension=".gif",
+            container_options={"loop": str(loop)}
+        ) as gif_file:
+            gif_file.init_video_stream(
+                "gif",
+                fps=1/playback_interval,  # Convert interval to fps
+                pixel_format="pal8"
+            )
+            gif_file.set_video_filter(filter_graph=filter_graph)
+            for frame in frames:
+                gif_file.write_frame(frame)
+
+    @staticmethod
+    def _write_paletted_gif(
+        frames: Iterable[np.ndarray],
+        palette: np.ndarray,
+        size: Tuple[int, int],
+        output: BinaryIO,
+        dither: str,
+        playback_interval: float,
+        repeat: str
+    ) -> None:
+        """Dither frames one at a time against a precomputed palette."""
+        # Set loop parameter based on repeat selection
+        loop = 0 if repeat == "Repeat" else -1
+
+        width, height = size
+        fps = Fraction(1/playback_interval).limit_denominator(65535)
+        time_base = 1 / fps
+
+        # paletteuse reads the palette as a 16x16 image of opaque BGRA
+        # pixels; pad short palettes by repeating their first color
+        bgra = np.full((256, 4), 255, dtype=np.uint8)
+        bgra[:, :3] = palette[0, ::-1]
+        bgra[:len(palette), :3] = palette[:, ::-1]
+        palette_frame = av.VideoFrame.from_ndarray(
+            bgra.reshape(16, 16, 4), format="bgra")
+        palette_frame.pts = 0
+
+        # paletteuse takes the frames on input 0 and the palette on input 1,
+        # and keeps using the last palette once that input ends
+        graph = av.filter.Graph()
+        source = graph.add_buffer(
+            width=width, height=height, format="rgb24", time_base=time_base)
+        palette_source = graph.add_buffer(
+            width=16, height=16, format="bgra", time_base=time_base)
+        paletteuse = graph.add("paletteuse", f"dither={dither}")
+        sink = graph.add("buffersink")
+        source.link_to(paletteuse, 0, 0)
+        palette_source.link_to(paletteuse, 0, 1)
+        paletteuse.link_to(sink)
+        graph.configure()
+
+        palette_source.push(palette_frame)
+        palette_source.push(None)
+
+        with av.open(
+            output,
+            "w",
+            format="gif",
+            container_options={"loop": str(loop)}
+        ) as container:
+            stream = container.add_stream("gif", rate=fps)
+            stream.pix_fmt = "pal8"
+            stream.width, stream.height = width, height
+
+            def drain() -> None:
+                while True:
+                    try:
+                        container.mux(stream.encode(sink.pull()))
+                    except (av.error.BlockingIOError, av.error.EOFError):
+                        return
+
+            for pts, rgb in enumerate(frames):
+                frame = av.VideoFrame.from_ndarray(rgb, format="rgb24")
+                frame.pts = pts
+                frame.time_base = time_base
+                source.push(frame)
+                drain()
+            source.push(None)
+            drain()
+            container.mux(stream.encode())
+
+    @staticmethod
+    def _write_indexed_gif(
+        indexed_frames: Iterable[np.ndarray],
+        palette: np.ndarray,
+        output: BinaryIO,
+        playback_interval: float,
+        repeat: str
+    ) -> None:
+        """Encode palette-indexed frames one at a time."""
+        # Set loop parameter based on repeat selection
+        loop = 0 if repeat == "Repeat" else -1
+
+        # PyAV takes pal8 palettes as 256 opaque ARGB entries
+        argb = np.zeros((256, 4), dtype=np.uint8)
+        argb[:, 0] = 255
+        argb[:len(palette), 1:] = palette
+
+        fps = Fraction(1/playback_interval).limit_denominator(65535)
+        with av.open(
+            output,
+            "w",
+            format="gif",
+            container_options={"loop": str(loop)}
+        ) as container:
+            stream = container.add_stream("gif", rate=fps)
+            stream.pix_fmt = "pal8"
+            for pts, indices in enumerate(indexed_frames):
+                if pts == 0:
+                    stream.height, stream.width = indices.shape
+                frame = av.VideoFrame.from_ndarray(
+                    (indices, argb), format="pal8")
+                frame.pts = pts
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+
+    @staticmethod
+    def _convert_with_ffmpeg(
+        video_path: str,
+        start_time: float,
+        duration: float,
+        settings: dict,
+        playback_interval: float,
+        repeat: str
+    ) -> bytes:
+        """Convert in one ffmpeg run, without materializing frames in Python."""
+        # Set loop parameter based on repeat selection
+        loop = 0 if repeat == "Repeat" else -1
+
+        playback_fps = 1/playback_interval
+        dither = settings["dither"] or "none"
+        filters = (
+            # Retime the kept frames to the playback rate
+            f"setpts=N/({playback_fps}*TB),"
+            f"split[a][b];[a]palettegen=max_colors={settings['colors']}[p];"
+            f"[b][p]paletteuse=dither={dither}"
+        )
+
+        # ffmpeg writes to a real path here, so keep that file on tmpfs
+        with tempfile.NamedTemporaryFile(
+            dir=SCRATCH_DIR, suffix=".gif"
+        ) as output_file:
+            cmd = [
+                FFMPEG_PATH, "-y", "-loglevel", "error",
+                "-ss", str(start_time),
+                "-t", str(duration),
+                "-i", video_path,
+                "-vf", filters,
+                "-r", str(playback_fps),
+                "-loop", str(loop),
+                output_file.name
+            ]
+            subprocess.run(cmd, check=True, capture_output=True)
+            return output_file.read()
+
     @staticmethod
     def convert_to_gif(
         video_path: str,
@@ -61,61 +284,222 @@ class GIFConverter:
         sample_interval: float,
         playback_interval: float,
         quality: str,
-        repeat: str
-    ) -> Optional[str]:
+        repeat: str,
+        video_info: Optional[Tuple[float, int, int, float]] = None,
+        keyframes: Optional[np.ndarray] = None
+    ) -> Optional[bytes]:
         """Convert video to GIF with custom sampling and playback intervals."""
         try:
-            clip = mp.VideoFileClip(video_path)
+            if video_info is None:
+                video_info = probe_video(video_path)
+            video_duration, width, height, source_fps = video_info
 
             # Validate start time and duration
-            if start_time >= clip.duration:
+            if start_time >= video_duration:
                 raise ValueError("Start time exceeds video duration")
 
-            end_time = min(start_time + duration, clip.duration)
+            end_time = min(start_time + duration, video_duration)
 
             # Calculate sampling times
             sample_times = np.arange(start_time, end_time, sample_interval)
 
-            # Create a sequence of frames at the sampling times
-            frames = []
-            for t in sample_times:
-                frames.append(clip.get_frame(t))
-
-            # Create a new clip from the sampled frames
-            sampled_clip = mp.ImageSequenceClip(
-                frames, fps=1/playback_interval)
-
-            # Create output directory if it doesn't exist
-            output_dir = Path("temp_gifs")
-            output_dir.mkdir(exist_ok=True)
-
-            output_path = str(
-                output_dir / f"output_{int(start_time)}_{int(duration)}.gif")
-
             # Apply quality settings
             settings = GIFConverter.QUALITY_SETTINGS[quality]
 
-            # Set loop parameter based on repeat selection
-            loop = 0 if repeat == "Repeat" else 1
-
-            sampled_clip.write_gif(
-                output_path,
-                fps=1/playback_interval,  # Convert interval to fps
-                program='ffmpeg',
-                opt=settings["opt"],
-                loop=loop
-            )
-
-            return output_path
+            # Every source frame is kept, so let ffmpeg do the whole job
+            if (FFMPEG_PATH is not None and source_fps > 0
+                    and abs(sample_interval - 1/source_fps) < 1e-3):
+                return GIFConverter._convert_with_ffmpeg(
+                    video_path,
+                    start_time,
+                    end_time - start_time,
+                    settings,
+                    playback_interval,
+                    repeat
+                )
+
+            # Encode in memory; nothing touches the disk
+            output = io.BytesIO()
+
+            # Windows too large to hold in RAM are decoded lazily instead
+            streamed = (len(sample_times) * height * width * 3
+                        > GIFConverter.STREAMING_THRESHOLD)
+
+            if streamed:
+                # Both streamed passes share one swscale context
+                reformatter = VideoReformatter()
+                frames = (rgb for _, rgb in iter_samples(
+                    video_path, sample_times, end_time, reformatter))
+            else:
+                frames = sample_frames(
+                    video_path, sample_times, end_time, keyframes)
+                if len(frames) == 0:
+                    raise ValueError("No frames decoded in the selected range")
+
+            # Few enough colors to index exactly: skip palette search and
+            # dithering altogether (screencasts, UI recordings, pixel art)
+            exact = None
+            if not streamed:
+                hist = rgb565_histogram(frames)
+                exact = exact_palette(frames, hist, settings["colors"])
+
+            if exact is not None:
+                palette, indexed_frames = exact
+                GIFConverter._write_indexed_gif(
+                    indexed_frames,
+                    palette,
+                    output,
+                    playback_interval,
+                    repeat
+                )
+            elif not streamed and settings["dither"] is not None:
+                GIFConverter._write_dithered_gif(
+                    frames,
+                    (width, height),
+                    output,
+                    settings["dither"],
+                    playback_interval,
+                    repeat
+                )
+            elif streamed:
+                # Pass 1 builds the palette from a histogram, pass 2
+                # re-decodes and quantizes or dithers frame by frame
+                hist = np.zeros(65536, dtype=np.int64)
+                for rgb in frames:
+                    hist += rgb565_histogram(rgb)
+                palette = palette_from_histogram(hist, settings["colors"])
+
+                second_pass = (
+                    rgb for _, rgb in iter_samples(
+                        video_path, sample_times, end_time, reformatter))
+                if settings["dither"] is not None:
+                    # paletteuse dithers against the fixed palette frame by
+                    # frame, where palettegen would hold every frame to EOF
+                    GIFConverter._write_paletted_gif(
+                        second_pass,
+                        palette,
+                        (width, height),
+                        output,
+                        settings["dither"],
+                        playback_interval,
+                        repeat
+                    )
+                else:
+                    GIFConverter._write_indexed_gif(
+                        (map_to_palette(rgb, palette) for rgb in second_pass),
+                        palette,
+                        output,
+                        playback_interval,
+                        repeat
+                    )
+            else:
+                palette = palette_from_histogram(hist, settings["colors"])
+                GIFConverter._write_indexed_gif(
+                    map_to_palette(frames, palette),
+                    palette,
+                    output,
+                    playback_interval,
+                    repeat
+                )
+
+            return output.getvalue()
 
         except Exception as e:
             logger.error(f"Error converting video to GIF: {str(e)}")
             return None
+
+
+class CachedUpload:
+    """An uploaded video persisted to a temp file for the cache's lifetime."""
+
+    def __init__(self, video_buffer) -> None:
+        fd, self.path = tempfile.mkstemp(suffix=".mp4")
+        try:
+            # Copy the upload's buffer straight into the file's page cache
+            size = len(video_buffer)
+            if size:
+                os.ftruncate(fd, size)
+                with mmap.mmap(fd, size) as mapped:
+                    mapped[:] = video_buffer
         finally:
-            if 'clip' in locals():
-                clip.close()
-            if 'sampled_clip' in locals():
-                sampled_clip.close()
+            os.close(fd)
+
+    def __del__(self) -> None:
+        # Runs once the cache evicts this upload
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+@st.cache_resource(max_entries=4)
+def get_cached_upload(video_hash: str, _video_buffer) -> CachedUpload:
+    """Persist each distinct upload once, keyed by its content hash."""
+    return CachedUpload(_video_buffer)
+
+
+@st.cache_data(max_entries=4)
+def get_video_info(
+    video_hash: str,
+    video_path: str
+) -> Tuple[float, int, int, float]:
+    """Probe duration, frame size and frame rate once per distinct upload."""
+    return probe_video(video_path)
+
+
+@st.cache_data(max_entries=4)
+def get_keyframe_times(video_hash: str, video_path: str) -> np.ndarray:
+    """Scan keyframe times once per distinct upload."""
+    return keyframe_times(video_path)
+
+
+async def run_in_background(
+    status,
+    convert: Callable[[], Optional[bytes]]
+) -> Optional[bytes]:
+    """Run a conversion in a worker thread while the status shows progress."""
+    task = asyncio.ensure_future(asyncio.to_thread(convert))
+    started = time.monotonic()
+    while not task.done():
+        status.update(
+            label=f"Converting... {time.monotonic() - started:.1f}s")
+        await asyncio.wait({task}, timeout=0.5)
+    return task.result()
+
+
+def convert_upload(
+    uploaded_file,
+    video_hash: str,
+    settings: tuple
+) -> Optional[bytes]:
+    """Convert an upload to a GIF, reporting progress in a status block."""
+    with st.status("Converting... Please wait") as status:
+        # Reuse the persisted file and metadata when the same
+        # video is converted again with different settings
+        status.write("Saving upload")
+        upload = get_cached_upload(video_hash, uploaded_file.getbuffer())
+
+        status.write("Reading video metadata")
+        video_info = get_video_info(video_hash, upload.path)
+        keyframes = get_keyframe_times(video_hash, upload.path)
+
+        # Convert to GIF
+        status.write("Sampling and encoding frames")
+        gif_bytes = asyncio.run(run_in_background(
+            status,
+            functools.partial(
+                GIFConverter.convert_to_gif,
+                upload.path,
+                *settings,
+                video_info=video_info,
+                keyframes=keyframes
+            )
+        ))
+
+        if gif_bytes:
+            status.update(label="Conversion completed", state="complete")
+        else:
+            status.update(label="Conversion failed", state="error")
+
+    return gif_bytes
 
 
 def main():
@@ -205,50 +589,52 @@ def main():
                 help="Choose if GIF should loop"
             )
 
+        # Hash each upload once; widget reruns reuse the stored digest
+        if st.session_state.get("upload_id") != uploaded_file.file_id:
+            st.session_state["upload_id"] = uploaded_file.file_id
+            st.session_state["video_hash"] = hashlib.sha1(
+                uploaded_file.getbuffer()).hexdigest()
+        video_hash = st.session_state["video_hash"]
+
+        conversion_key = (
+            video_hash,
+            start_time,
+            duration,
+            sample_interval,
+            playback_interval,
+            quality,
+            repeat
+        )
+
         if st.button("🎬 Convert to GIF", use_container_width=True):
             try:
-                with st.spinner("Converting... Please wait"):
-                    # Save uploaded file temporarily
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_file:
-                        temp_file.write(uploaded_file.getbuffer())
-                        temp_file_path = temp_file.name
-
-                    # Convert to GIF
-                    gif_path = GIFConverter.convert_to_gif(
-                        temp_file_path,
-                        start_time,
-                        duration,
-                        sample_interval,
-                        playback_interval,
-                        quality,
-                        repeat
+                # Same video and settings as last time: reuse that GIF
+                if (st.session_state.get("last_key") == conversion_key
+                        and "last_gif" in st.session_state):
+                    gif_bytes = st.session_state["last_gif"]
+                else:
+                    gif_bytes = convert_upload(
+                        uploaded_file, video_hash, conversion_key[1:])
+                    if gif_bytes:
+                        st.session_state["last_gif"] = gif_bytes
+                        st.session_state["last_key"] = conversion_key
+
+                if gif_bytes:
+                    st.success("✨ Conversion completed!")
+
+                    # Display the GIF
+                    st.image(gif_bytes, caption="Your converted GIF")
+
+                    # Add download button
+                    st.download_button(
+                        label="⬇️ Download GIF",
+                        data=gif_bytes,
+                        file_name="converted.gif",
+                        mime="image/gif"
                     )
-
-                    # Clean up temporary video file
-                    os.unlink(temp_file_path)
-
-                    if gif_path and os.path.exists(gif_path):
-                        st.success("✨ Conversion completed!")
-
-                        # Display the GIF
-                        with open(gif_path, "rb") as gif_file:
-                            st.image(gif_file.read(),
-                                     caption="Your converted GIF")
-
-                        # Add download button
-                        with open(gif_path, "rb") as gif_file:
-                            st.download_button(
-                                label="⬇️ Download GIF",
-                                data=gif_file,
-                                file_name="converted.gif",
-                                mime="image/gif"
-                            )
-
-                        # Clean up GIF file
-                        os.unlink(gif_path)
-                    else:
-                        st.error(
-                            "Failed to convert video to GIF. Please try again.")
+                else:
+                    st.error(
+                        "Failed to convert video to GIF. Please try again.")
 
             except Exception as e:
                 logger.error(f"Error in conversion process: {str(e)}")
@@ -0,0 +1,120 @@
+"""Palette quantization helpers for the GIF converter."""
+import functools
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def rgb565_histogram(frame: np.ndarray) -> np.ndarray:
+    """Count pixels of one or more frames in a 64K-bin RGB565 histogram."""
+    packed = (
+        ((frame[..., 0] & 0xF8).astype(np.uint16) << 8)
+        | ((frame[..., 1] & 0xFC).astype(np.uint16) << 3)
+        | (frame[..., 2] >> 3)
+    )
+    return np.bincount(packed.ravel(), minlength=65536)
+
+
+def palette_from_histogram(hist: np.ndarray, colors: int = 256) -> np.ndarray:
+    """Median-cut a palette from an RGB565 histogram."""
+    keys = np.flatnonzero(hist)
+    weights = hist[keys].astype(np.float64)
+    # Expand the 5/6/5-bit channels back to the full 8-bit range
+    r = (keys >> 11) & 0x1F
+    g = (keys >> 5) & 0x3F
+    b = keys & 0x1F
+    rgb = np.stack(
+        [(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)],
+        axis=1
+    ).astype(np.float64)
+
+    def score(box: np.ndarray) -> float:
+        # Favour boxes that are both wide and heavily populated
+        if len(box) < 2:
+            return 0.0
+        return float(np.ptp(rgb[box], axis=0).max() * weights[box].sum())
+
+    boxes = [np.arange(len(keys))]
+    scores = [score(boxes[0])]
+    while len(boxes) < colors:
+        j = int(np.argmax(scores))
+        if scores[j] == 0:
+            break
+        box = boxes.pop(j)
+        scores.pop(j)
+
+        # Split at the weighted median of the widest channel
+        channel = int(np.ptp(rgb[box], axis=0).argmax())
+        ordered = box[np.argsort(rgb[box, channel], kind='stable')]
+        cumulative = np.cumsum(weights[ordered])
+        cut = int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1
+        cut = min(max(cut, 1), len(ordered) - 1)
+        for half in (ordered[:cut], ordered[cut:]):
+            boxes.append(half)
+            scores.append(score(half))
+
+    palette = [np.average(rgb[box], axis=0, weights=weights[box])
+               for box in boxes]
+    return np.round(palette).astype(np.uint8)
+
+
+def pack_rgb(pixels: np.ndarray) -> np.ndarray:
+    """Pack the last (RGB) axis into full 24-bit uint32 keys."""
+    return (
+        (pixels[..., 0].astype(np.uint32) << 16)
+        | (pixels[..., 1].astype(np.uint32) << 8)
+        | pixels[..., 2]
+    )
+
+
+def exact_palette(
+    frames: np.ndarray,
+    hist: np.ndarray,
+    colors: int = 256
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Return (palette, indices) if the frames use at most `colors` colors."""
+    # Every distinct color lands in some RGB565 bin, so more occupied bins
+    # than palette slots rules this out without sorting any pixels
+    if np.count_nonzero(hist) > colors:
+        return None
+
+    keys = pack_rgb(frames)
+    unique = np.unique(keys)
+    if len(unique) > colors:
+        return None
+
+    palette = np.stack(
+        [(unique >> 16) & 0xFF, (unique >> 8) & 0xFF, unique & 0xFF],
+        axis=1
+    ).astype(np.uint8)
+    indices = np.searchsorted(unique, keys).astype(np.uint8)
+    return palette, indices
+
+
+def _nearest_indices(rgb: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """Return the index of the nearest palette color for each RGB row."""
+    tree = cKDTree(palette.astype(np.float32))
+    _, idx = tree.query(rgb, k=1)
+    return idx.astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=4)
+def _index_cache(palette_bytes: bytes) -> np.ndarray:
+    """Precompute the nearest palette index for every cell of a 32^3 cube."""
+    palette = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(-1, 3)
+    # Represent each 5-bit cell by its 8-bit center
+    levels = (np.arange(32) << 3) | 4
+    r, g, b = np.meshgrid(levels, levels, levels, indexing='ij')
+    centers = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+    cache = _nearest_indices(centers, palette).reshape(32, 32, 32)
+    cache.flags.writeable = False
+    return cache
+
+
+def map_to_palette(frames: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """Map every pixel to the index of its nearest palette color."""
+    # A 32 KB table indexed by the top 5 bits of each channel replaces any
+    # per-pixel search. It is keyed by the palette, so reconverting with the
+    # same palette reuses it and a new palette gets a fresh table.
+    cache = _index_cache(palette.tobytes())
+    return cache[frames[..., 0] >> 3, frames[..., 1] >> 3, frames[..., 2] >> 3]